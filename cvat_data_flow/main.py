@@ -24,7 +24,11 @@ def main():
 
     # download data
     if not options.only_build_dataset:
-        if len(os.listdir(options.raw_data_path)) == 0:
+        # stop at the first entry instead of listing every downloaded task
+        with os.scandir(options.raw_data_path) as entries:
+            is_empty = next(entries, None) is None
+
+        if is_empty:
             cvat_data_flow.download_data()
         else:
             cvat_data_flow.logger.info("Data already downloaded")
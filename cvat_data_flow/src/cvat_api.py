@@ -1,17 +1,21 @@
 import os
 import shutil
 import zipfile
-import json
 import logging
-from typing import List, Union
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional, Tuple, Union
 from logging import FileHandler
 
 from cvat_sdk import make_client
+from cvat_sdk.core.helpers import get_paginated_collection
 from cvat_sdk.core.proxies.tasks import Task
 from cvat_sdk.core.proxies.projects import Project
 from cvat_sdk.api_client.models import PatchedTaskWriteRequest
 from tqdm import tqdm
 
+# Read/write buffer for downloaded archives, large chunks let zlib inflate more at once
+ARCHIVE_BUFFER_SIZE = 1 << 20
+
 
 class CVAT_API:
     """
@@ -34,17 +38,18 @@ class CVAT_API:
     ```
     """
 
-    def __init__(self, url: str, login: str, password: str, save_path: str):
+    def __init__(self, url: str, login: str, password: str, save_path: str, max_workers: int = 8):
         """
         :param url: CVAT url.
         :param login: CVAT login.
         :param password: CVAT password.
         :param save_path: Path to the directory where the dataset will be saved.
+        :param max_workers: Maximum number of tasks exported from CVAT concurrently.
         """
         self.logger = self._setup_logger()
+        self.max_workers = max_workers
         self.client = self._connect_to_cvat(url, login, password)
         self.downloads_directory = self._setup_save_directory(save_path)
-        self.img_num = 0
 
     @staticmethod
     def _setup_logger() -> logging.Logger:
@@ -60,69 +65,94 @@ class CVAT_API:
         """Establish a connection to CVAT."""
         self.logger.info(f'Connecting to CVAT "{url}" ...')
         client = make_client(host=url, credentials=(login, password))
+        self._setup_connection_pool(client)
         return client
 
+    def _setup_connection_pool(self, client) -> None:
+        """
+        Make the client's keep-alive pool large enough for concurrent exports.
+
+        Connections returned to a full urllib3 pool are discarded, so without this
+        every download beyond the pool size would pay a fresh TCP/TLS handshake.
+        """
+        pool_manager = client.api_client.rest_client.pool_manager
+        if pool_manager.connection_pool_kw.get('maxsize', 1) < self.max_workers:
+            pool_manager.connection_pool_kw['maxsize'] = self.max_workers
+            # Pools are created lazily, drop the one opened during login to apply the new size
+            pool_manager.clear()
+
     @staticmethod
     def _setup_save_directory(save_path: str) -> str:
         """Create the directory for saving datasets if it doesn't exist."""
         os.makedirs(save_path, exist_ok=True)
         return save_path
 
-    def _process_data(self, path: str) -> None:
-        """Rename images and update annotation file."""
-        annotation_path = os.path.join(path, 'annotations', 'default.json')
-        images_path = os.path.join(path, 'images')
-
-        with open(annotation_path, 'r') as f:
-            data = json.load(f)
+    def _get_dataset_paths(self, object_id: int) -> Tuple[str, str]:
+        """Return the archive path and the extraction directory for a CVAT object."""
+        target_directory = os.path.join(self.downloads_directory, str(object_id))
+        return f'{target_directory}.zip', target_directory
 
-        for item in data['items']:
-            old_image_path = os.path.join(images_path, item['image']['path'])
-            new_image_path = os.path.join(images_path, f'{self.img_num}.jpg')
-            os.rename(old_image_path, new_image_path)
-
-            item['image']['path'] = item['id'] = item['media']['path'] = f'{self.img_num}.jpg'
-            self.img_num += 1
-
-        with open(annotation_path, 'w') as f:
-            json.dump(data, f, indent=4)
-
-    def _download_and_extract(self, cvat_object: Union[Task, Project], include_images: bool) -> None:
-        """Download and extract dataset from CVAT."""
-        archive_path = os.path.join(self.downloads_directory, f'{cvat_object.id}.zip')
+    def _download_dataset(
+        self, cvat_object: Union[Task, Project], include_images: bool
+    ) -> Optional[Tuple[str, str]]:
+        """Download dataset archive from CVAT, return it and the target path or None on failure."""
+        archive_path, target_directory = self._get_dataset_paths(cvat_object.id)
 
         self.logger.debug(f'Downloading "{archive_path}" ...')
         try:
             cvat_object.export_dataset('Datumaro 1.0', archive_path, include_images=include_images)
         except Exception as e:
             self.logger.error(f'Failed to download "{archive_path}": {e}')
-            return
+            return None
 
-        self._extract_dataset(archive_path, include_images)
+        return archive_path, target_directory
 
-    def _extract_dataset(self, archive_path: str, include_images: bool) -> None:
+    def _extract_dataset(
+        self, archive_path: str, target_directory: str, include_images: bool
+    ) -> None:
         """Extract the downloaded dataset archive."""
-        dataset_name = os.path.splitext(os.path.basename(archive_path))[0]
-        target_directory = os.path.join(self.downloads_directory, dataset_name)
         os.makedirs(target_directory, exist_ok=True)
 
         self.logger.debug(f'Extracting "{archive_path}" to "{target_directory}" ...')
 
         try:
-            with zipfile.ZipFile(archive_path, 'r') as zip_ref:
-                zip_ref.extractall(target_directory)
+            with open(archive_path, 'rb', buffering=ARCHIVE_BUFFER_SIZE) as archive, \
+                    zipfile.ZipFile(archive, 'r') as zip_ref:
+                self._extract_members(zip_ref, target_directory)
 
             if include_images:
                 self._move_and_cleanup_images(target_directory)
 
         except Exception as e:
             self.logger.error(f'Failed to extract "{archive_path}": {e}')
+            # Do not leave a partial task behind, it would be taken as downloaded on the next run
+            shutil.rmtree(target_directory, ignore_errors=True)
             os.remove(archive_path)
             return
 
         self.logger.debug(f'Successfully extracted "{archive_path}"')
         os.remove(archive_path)
 
+    @staticmethod
+    def _extract_members(zip_ref: zipfile.ZipFile, target_directory: str) -> None:
+        """Extract archive members, copying each one with a large buffer."""
+        root = os.path.abspath(target_directory)
+
+        for info in zip_ref.infolist():
+            if info.is_dir():
+                continue
+
+            output_path = os.path.abspath(os.path.join(root, info.filename))
+            # Keep extractall's guarantee that members never escape the target directory
+            if os.path.commonpath([root, output_path]) != root:
+                raise ValueError(
+                    f'Archive member "{info.filename}" is outside the target directory'
+                )
+
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            with zip_ref.open(info) as src, open(output_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, length=ARCHIVE_BUFFER_SIZE)
+
     def _move_and_cleanup_images(self, target_directory: str) -> None:
         """Move images from the 'default' subfolder and clean up."""
         source_images_dir = os.path.join(target_directory, 'images', 'default')
@@ -132,14 +162,31 @@ class CVAT_API:
             self.logger.warning(f'Source images directory "{source_images_dir}" does not exist.')
             return
 
-        for image in os.listdir(source_images_dir):
-            shutil.move(os.path.join(source_images_dir, image), target_images_dir)
+        # When 'default' is the only subset, swap the directories instead of moving every image
+        if os.listdir(target_images_dir) == ['default']:
+            tmp_images_dir = os.path.join(target_directory, 'images_tmp')
+            os.rename(target_images_dir, tmp_images_dir)
+            os.rename(os.path.join(tmp_images_dir, 'default'), target_images_dir)
+            os.rmdir(tmp_images_dir)
+            return
+
+        with os.scandir(source_images_dir) as entries:
+            images = [entry.name for entry in entries]
+
+        # 'default' is inside the target directory, so a plain rename is enough
+        for image in images:
+            image_path = os.path.join(target_images_dir, image)
+            # Fail like shutil.move instead of letting os.rename overwrite an existing image
+            if os.path.exists(image_path):
+                raise shutil.Error(f"Destination path '{image_path}' already exists")
+            os.rename(os.path.join(source_images_dir, image), image_path)
 
-        shutil.rmtree(source_images_dir)
+        # Every image has been moved out, a non-empty directory here means a move was missed
+        os.rmdir(source_images_dir)
 
     def _backup(self, cvat_object: Union[Task, Project]) -> None:
         """Backup project or task from CVAT."""
-        archive_path = os.path.join(self.downloads_directory, f'{cvat_object.id}.zip')
+        archive_path, _ = self._get_dataset_paths(cvat_object.id)
 
         self.logger.debug(f'Backing up "{archive_path}" ...')
         try:
@@ -152,23 +199,60 @@ class CVAT_API:
 
     def _get_project_tasks(self, project_id: int) -> List[Task]:
         """Retrieve tasks from the given project."""
-        project = self.client.projects.retrieve(int(project_id))
-        tasks = project.get_tasks()
+        # Query the tasks list by project id directly instead of retrieving the project first,
+        # large pages keep the number of round-trips low for big projects
+        task_models = get_paginated_collection(
+            self.client.api_client.tasks_api.list_endpoint,
+            project_id=int(project_id),
+            page_size=500,
+        )
+        tasks = [Task(self.client, model) for model in task_models]
+        if not tasks:
+            # An unknown project id also gives no tasks, retrieving the project raises for it
+            self.client.projects.retrieve(int(project_id))
         self.logger.info(f'Found {len(tasks)} tasks in project "{project_id}"')
         return tasks
 
-    def upload_tasks_from_cvat(self, tasks: List[Union[Task, int]], include_images: bool) -> None:
-        """Upload tasks from CVAT."""
-        tasks = [self.client.tasks.retrieve(int(task)) if not isinstance(task, Task) else task for task in tasks]
+    def _is_downloaded(self, task_id: int) -> bool:
+        """Check whether the task has already been downloaded and extracted."""
+        _, target_directory = self._get_dataset_paths(task_id)
+        return os.path.exists(os.path.join(target_directory, 'annotations', 'default.json'))
+
+    def upload_tasks_from_cvat(
+        self, tasks: List[Union[Task, int]], include_images: bool, force: bool = False
+    ) -> None:
+        """Upload tasks from CVAT, skipping already extracted ones unless force is set."""
+        if not force:
+            pending = [
+                task for task in tasks
+                if not self._is_downloaded(task.id if isinstance(task, Task) else task)
+            ]
+            if len(pending) < len(tasks):
+                self.logger.info(f'Skipping {len(tasks) - len(pending)} already downloaded tasks')
+            tasks = pending
 
-        for task in tqdm(tasks):
-            self._download_and_extract(task, include_images)
+        tasks = [self.client.tasks.retrieve(int(task)) if not isinstance(task, Task) else task for task in tasks]
 
-    def upload_projects_from_cvat(self, project_ids: List[int], include_images: bool) -> None:
+        # Exports are dominated by waiting on the CVAT server, so run them concurrently
+        # and extract each archive as soon as it arrives, while the rest are still downloading
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [
+                executor.submit(self._download_dataset, task, include_images) for task in tasks
+            ]
+
+            extract_dataset = self._extract_dataset
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                paths = future.result()
+                if paths:
+                    extract_dataset(*paths, include_images)
+
+    def upload_projects_from_cvat(
+        self, project_ids: List[int], include_images: bool, force: bool = False
+    ) -> None:
         """Upload projects from CVAT."""
         for project_id in tqdm(project_ids):
             tasks = self._get_project_tasks(project_id)
-            self.upload_tasks_from_cvat(tasks=tasks, include_images=include_images)
+            self.upload_tasks_from_cvat(tasks=tasks, include_images=include_images, force=force)
 
         self.logger.info(f'Finished uploading projects {project_ids} from CVAT.')
 
@@ -200,28 +284,38 @@ class CVAT_API:
     def create_task_from_backup(self, archive_path: str, organization_slug: str = 'RegularXRAY', project_id: int = 2) -> None:
         """Restore tasks to CVAT from backup."""
         self.client.organization_slug = organization_slug
+        patched_task = PatchedTaskWriteRequest(project_id=project_id) if project_id else None
+        self._restore_backup(archive_path, patched_task)
+
+    def _restore_backup(
+        self, archive_path: str, patched_task: Optional[PatchedTaskWriteRequest]
+    ) -> None:
+        """Restore a task from backup and apply the (shared) patch request to it."""
         task = self.client.tasks.create_from_backup(archive_path)
 
-        if project_id:
-            patched_task = PatchedTaskWriteRequest(project_id=project_id)
+        if patched_task is not None:
             task.update(patched_task)
 
     def create_tasks_from_backups(self, backups_path: str, organization_slug: str = 'RegularXRAY', project_id: int = None) -> None:
         """Restore tasks to CVAT from backups."""
-        backups = os.listdir(backups_path)
+        with os.scandir(backups_path) as entries:
+            backups = [entry.path for entry in entries]
         self.logger.info(f'Found {len(backups)} backups in "{backups_path}"')
 
-        for backup in tqdm(backups):
-            archive_path = os.path.join(backups_path, backup)
-            self.create_task_from_backup(archive_path, organization_slug, project_id)
+        # The patch request is the same for every restored task, build it once
+        self.client.organization_slug = organization_slug
+        patched_task = PatchedTaskWriteRequest(project_id=project_id) if project_id else None
+
+        for archive_path in tqdm(backups):
+            self._restore_backup(archive_path, patched_task)
 
         self.logger.info(f'Finished creating tasks from backups in "{backups_path}"')
 
     def move_tasks_to_project(self, task_ids: List[int], project_id: int) -> None:
         """Move tasks to a different project."""
+        patched_task = PatchedTaskWriteRequest(project_id=project_id)
         for task_id in tqdm(task_ids):
             task = self.client.tasks.retrieve(task_id)
-            patched_task = PatchedTaskWriteRequest(project_id=project_id)
             task.update(patched_task)
 
         self.logger.info(f'Moved tasks {task_ids} to project "{project_id}"')
\ No newline at end of file
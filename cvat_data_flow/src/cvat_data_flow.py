@@ -6,8 +6,6 @@ for downloading and building datasets from CVAT.
 import os
 import logging
 import coloredlogs
-from .cvat_api import CVAT_API
-from .dataset_builder import CustomDataset
 
 
 class CVATDataFlow:
@@ -34,6 +32,11 @@ class CVATDataFlow:
     ```
     """
 
+    __slots__ = (
+        'url', 'login', 'password', 'raw_data_path', 'projects_ids', 'tasks_ids', 'format',
+        'split', 'labels_mapping', 'debug', 'labels_id_mapping', 'logger', 'cvat_uploader'
+    )
+
     def __init__(
         self, url: str, login: str, password: str, raw_data_path: str,
         projects_ids: list, tasks_ids: list,
@@ -83,24 +86,32 @@ class CVATDataFlow:
 
     def _initialize_cvat_uploader(self):
         """Initialize the CVAT API uploader."""
+        # cvat_sdk is imported only when data is downloaded, building a dataset does not need it
+        from .cvat_api import CVAT_API
+
         self.cvat_uploader = CVAT_API(
             url=self.url, login=self.login, password=self.password, save_path=self.raw_data_path
         )
 
-    def download_data(self, include_images: bool = False) -> None:
+    def download_data(self, include_images: bool = False, force: bool = False) -> None:
         """
         Download data from CVAT.
 
         Downloads either specific tasks or projects based on the provided IDs.
+        Tasks already present in the raw data path are skipped unless force is set.
         """
         self._initialize_cvat_uploader()
 
         if not self.projects_ids:
             self.logger.info(f'Start downloading tasks {self.tasks_ids} ...')
-            self.cvat_uploader.upload_tasks_from_cvat(tasks=self.tasks_ids, include_images=include_images)
+            self.cvat_uploader.upload_tasks_from_cvat(
+                tasks=self.tasks_ids, include_images=include_images, force=force
+            )
         else:
             self.logger.info(f'Start downloading projects {self.projects_ids} ...')
-            self.cvat_uploader.upload_projects_from_cvat(project_ids=self.projects_ids, include_images=include_images)
+            self.cvat_uploader.upload_projects_from_cvat(
+                project_ids=self.projects_ids, include_images=include_images, force=force
+            )
 
     def build_dataset(self, save_path: str = None) -> str:
         """
@@ -116,6 +127,9 @@ class CVATDataFlow:
             raise FileNotFoundError(f'The specified raw data path "{self.raw_data_path}" does not exist.')
 
         self.logger.info(f'Building dataset in {self.format} format from {self.raw_data_path} ...')
+        # Datumaro is imported only when a dataset is built, downloading data does not need it
+        from .dataset_builder import CustomDataset
+
         dataset = CustomDataset(
             datasets_path=self.raw_data_path,
             export_format=self.format,
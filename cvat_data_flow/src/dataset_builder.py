@@ -1,12 +1,29 @@
 # Description: Class for merging and transforming datasets in Datumaro format.
 
 import os
+import shutil
+import hashlib
 import logging
+import threading
 from collections import OrderedDict
+from copy import copy
+from concurrent.futures import ThreadPoolExecutor
 from datumaro import Dataset, HLOps, AnnotationType
+from datumaro.components.annotation import COORDINATE_ROUNDING_DIGITS
+from datumaro.components.media import Image
+from datumaro.components.transformer import ItemTransform
+from datumaro.plugins.transforms import RemapLabels
 from datumaro.plugins.data_formats.coco.exporter import _InstancesExporter, CocoTask, cast
+from datumaro.util import find
+from datumaro.util import annotation_util as anno_tools
 from .utils.coco_converter import COCOConverter
 
+# Number of merged datasets kept in the cache, the least recently used ones are removed
+MERGE_CACHE_SIZE = 2
+MERGE_POLICY = 'union'
+# Shapes the COCO instances exporter writes as polygons
+POLYGON_TYPES = {AnnotationType.polygon, AnnotationType.ellipse}
+
 # Patch Coco _InstancesExporter to save categories in the same order as in the dataset
 class PatchInstancesExporter(_InstancesExporter):
     def save_categories(self, dataset):
@@ -14,16 +31,124 @@ class PatchInstancesExporter(_InstancesExporter):
         if label_categories is None:
             return
 
-        label_categories_name_ind = dataset.categories().get(AnnotationType.label)._indices
+        # Label names are strings already, cast only what is not
+        self.categories.extend(
+            {
+                "id": 1 + ind,
+                "name": name if isinstance(name, str) else cast(name, str, ""),
+                "supercategory": "",
+            }
+            for name, ind in label_categories._indices.items()
+        )
+
+class ReindexLabels(ItemTransform):
+    """
+    Lazily reindex annotation labels to target IDs.
+
+    Being an item transform, it is stacked with the other transforms (random_split, remap_labels)
+    and applied in the same pass over the items as the export.
+    """
+
+    def __init__(self, extractor, labels_id_mapping: dict):
+        """
+        :param extractor: Source extractor.
+        :param labels_id_mapping: Dict mapping label names to target IDs. Example: {'label_name': target_id}.
+        """
+        super().__init__(extractor)
+
+        categories = dict(extractor.categories())
+        label_categories = copy(categories[AnnotationType.label])
+        # Source index -> target id in one list, labels missing from the mapping are left as None
+        source_indices = label_categories._indices
+        self._ind_to_target = [None] * (max(source_indices.values(), default=-1) + 1)
+        for name, ind in source_indices.items():
+            self._ind_to_target[ind] = labels_id_mapping.get(name)
+        self._ind_to_name = {ind: name for name, ind in source_indices.items()}
+        label_categories._indices = labels_id_mapping
+        categories[AnnotationType.label] = label_categories
+        self._categories = categories
+
+    def categories(self):
+        return self._categories
+
+    def transform_item(self, item):
+        ind_to_target = self._ind_to_target
+        labels = [ind_to_target[annotation.label] for annotation in item.annotations]
+        if None in labels:
+            label = item.annotations[labels.index(None)].label
+            raise KeyError(self._ind_to_name.get(label, label))
+
+        return item.wrap(annotations=[
+            annotation.wrap(label=label) for annotation, label in zip(item.annotations, labels)
+        ])
+
+
+class RemapLabelsTable(RemapLabels):
+    """
+    remap_labels transform that resolves the new label of an annotation by a list index.
+
+    Categories are remapped by the Datumaro transform, only the per-annotation lookup is replaced.
+    """
+    def __init__(self, extractor, mapping, default=None):
+        """
+        :param extractor: Source extractor.
+        :param mapping: List of tuples for label mapping. Example: [('source_label', 'target_label')].
+        :param default: Action for labels missing from the mapping, 'keep' or 'delete'.
+            Default: 'keep'.
+        """
+        super().__init__(extractor, mapping, default)
+
+        src_label_cat = extractor.categories().get(AnnotationType.label)
+        # Source index -> target index, None for deleted labels
+        self._id_table = [
+            self._map_id(ind) for ind in range(len(src_label_cat))
+        ] if src_label_cat else []
+
+    def transform_item(self, item):
+        id_table = self._id_table
+        keep_unlabeled = self._default_action is self.DefaultAction.keep
+
+        annotations = []
+        for annotation in item.annotations:
+            label = getattr(annotation, 'label', None)
+            if label is not None:
+                label = id_table[label]
+                if label is not None:
+                    annotations.append(annotation.wrap(label=label))
+            elif keep_unlabeled:
+                annotations.append(annotation.wrap())
+
+        return item.wrap(annotations=annotations)
+
+
+class RelativeMediaPaths(ItemTransform):
+    """
+    Point images to their '<subset>/<item_id><ext>' files under the images directory
+    of the exported dataset.
+
+    Lets the merge cache be exported without media and reference images linked next to it instead.
+    """
+
+    def transform_item(self, item):
+        image = item.media
+        if not isinstance(image, Image) or not image.has_data:
+            return item
+
+        return item.wrap(media=Image.from_file(
+            path=_image_filename(item),
+            size=image.size if image.has_size else None
+        ))
+
+
+def _image_filename(item) -> str:
+    """
+    Get the file name of an item image inside its subset directory.
+
+    :param item: Datumaro dataset item with an image.
+    :return: Item ID followed by the image extension, '.jpg' if it is unknown.
+    """
+    return item.id + (item.media.ext or '.jpg')
 
-        for name, ind in label_categories_name_ind.items():
-            self.categories.append(
-                {
-                    "id": 1 + ind,
-                    "name": cast(name, str, ""),
-                    "supercategory": "",
-                }
-            )
 
 class CustomDataset:
     """
@@ -48,7 +173,9 @@ class CustomDataset:
                  export_format: str = 'coco', 
                  splits: list = None, 
                  mapping: list = None, 
-                 labels_id_mapping: dict = None):
+                 labels_id_mapping: dict = None,
+                 merge_cache_dir: str = None,
+                 link_media: bool = False):
         """
         Initialize the CustomDataset object.
 
@@ -57,12 +184,21 @@ class CustomDataset:
         :param splits: List of tuples describing the data splits. Example: [('subset_name', part_of_subset: float)].
         :param mapping: List of tuples describing label mapping. Example: [('source_label', 'target_label')].
         :param labels_id_mapping: Dict mapping label names to target IDs. Example: {'label_name': target_id}.
+        :param merge_cache_dir: Directory to keep merged datasets in, reused while the source
+            tasks are unchanged. The cached images are hard-linked from the sources, so it should
+            be on the same filesystem as datasets_path. Default: None, no cache.
+        :param link_media: Hard-link images into the exported dataset instead of copying them
+            when possible.
+            Linked images share their files with the sources in datasets_path, editing them in place
+            (resizing, re-encoding) changes the downloaded data as well. Default: False.
         """
         self.datasets_path = datasets_path
         self.export_format = export_format
         self.splits = splits
         self.mapping = mapping
         self.labels_id_mapping = labels_id_mapping
+        self.merge_cache_dir = merge_cache_dir
+        self.link_media = link_media
         self.logger = logging.getLogger(__name__)
 
         self.dataset = self._create_dataset()
@@ -71,49 +207,135 @@ class CustomDataset:
         """
         Create a Datumaro dataset by merging datasets in Datumaro format.
 
+        :return: Merged Datumaro dataset.
+        """
+        if not self.merge_cache_dir:
+            return self._merge_source_datasets()
+
+        cache_dir = os.path.join(self.merge_cache_dir, self._fingerprint())
+
+        if os.path.isdir(cache_dir):
+            self.logger.info(f'Loading merged dataset from cache "{cache_dir}"')
+            try:
+                # Refresh mtime, it is used to find the least recently used entries
+                os.utime(cache_dir)
+            except OSError:
+                pass
+            return Dataset.import_from(cache_dir, 'datumaro')
+
+        dataset = self._merge_source_datasets()
+
+        # Export to a temporary directory first, an interrupted export must not look like
+        # a valid cache
+        tmp_cache_dir = f'{cache_dir}.tmp'
+        try:
+            shutil.rmtree(tmp_cache_dir, ignore_errors=True)
+            # Images are linked into the cache rather than copied, it must not double
+            # the disk usage of the sources
+            exporter = dataset.env.exporters.get('datumaro')
+            exporter.convert(RelativeMediaPaths(dataset), save_dir=tmp_cache_dir, save_media=False)
+            self._export_media(dataset, tmp_cache_dir, link=True)
+            os.rename(tmp_cache_dir, cache_dir)
+            self._prune_merge_cache(self.merge_cache_dir)
+        except OSError as e:
+            # The cache is only an optimization, a read-only or full volume must not fail the build
+            self.logger.warning(
+                f'Failed to cache the merged dataset in "{self.merge_cache_dir}": {e}'
+            )
+            shutil.rmtree(tmp_cache_dir, ignore_errors=True)
+
+        return dataset
+
+    def _merge_source_datasets(self) -> Dataset:
+        """
+        Merge the source datasets into one.
+
         :return: Merged Datumaro dataset.
         """
         source_datasets = self._create_source_datasets()
-        return HLOps.merge(*source_datasets, merge_policy="union")
+        return HLOps.merge(*source_datasets, merge_policy=MERGE_POLICY)
 
-    def _create_source_datasets(self) -> list:
+    def _get_source_names(self) -> list:
         """
-        Create a list of Dataset objects from tasks in Datumaro format.
+        Get names of the task folders in datasets_path.
 
-        :return: List of Datumaro datasets.
+        :return: List of task folder names.
+        """
+        # The merge cache may be kept inside datasets_path, it is not a task
+        cache_dir = os.path.abspath(self.merge_cache_dir) if self.merge_cache_dir else None
+        with os.scandir(self.datasets_path) as entries:
+            return [
+                entry.name for entry in entries
+                if entry.is_dir() and os.path.abspath(entry.path) != cache_dir
+            ]
+
+    def _fingerprint(self) -> str:
         """
-        return [Dataset.import_from(os.path.join(self.datasets_path, name), 'datumaro') for name in os.listdir(self.datasets_path)]
+        Compute a fingerprint of the source tasks from relative paths, mtimes and sizes
+        of their files.
 
-    def _mapping_labels(self, dataset: Dataset, mapping: list) -> Dataset:
+        :return: Hex digest identifying the current state of the sources.
         """
-        Map labels from source to target.
+        entries = []
+        for name in self._get_source_names():
+            for root, _, files in os.walk(os.path.join(self.datasets_path, name)):
+                for file_name in files:
+                    path = os.path.join(root, file_name)
+                    stat = os.stat(path)
+                    relative_path = os.path.relpath(path, self.datasets_path)
+                    entries.append(f'{relative_path}:{stat.st_mtime_ns}:{stat.st_size}')
+
+        digest = hashlib.blake2b(MERGE_POLICY.encode(), digest_size=16)
+        for entry in sorted(entries):
+            digest.update(entry.encode())
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    @staticmethod
+    def _prune_merge_cache(cache_root: str) -> None:
+        """
+        Remove the least recently used merged datasets beyond MERGE_CACHE_SIZE.
 
-        :param dataset: Datumaro dataset.
-        :param mapping: List of tuples for label mapping. Example: [('source_label', 'target_label')].
+        :param cache_root: Path to the merge cache directory.
+        """
+        with os.scandir(cache_root) as entries:
+            cached = sorted(
+                (entry for entry in entries if entry.is_dir()),
+                key=lambda entry: entry.stat().st_mtime,
+            )
 
-        :return: Mapped Datumaro dataset.
+        for entry in cached[:-MERGE_CACHE_SIZE]:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+    def _create_source_datasets(self) -> list:
         """
-        return dataset.transform('remap_labels', mapping=mapping)
+        Create a list of Dataset objects from tasks in Datumaro format.
 
-    def _reindex_labels(self, dataset: Dataset, labels_id_mapping: dict) -> Dataset:
+        :return: List of Datumaro datasets.
         """
-        Reindex labels in the dataset.
+        return [
+            Dataset.import_from(os.path.join(self.datasets_path, name), 'datumaro')
+            for name in self._get_source_names()
+        ]
 
-        :param dataset: Datumaro dataset.
-        :param labels_id_mapping: Dict mapping label names to target IDs.
+    def _get_transforms(self) -> list:
+        """
+        Get the transforms to apply to the merged dataset before the export.
 
-        :return: Reindexed Datumaro dataset.
+        :return: List of tuples (transform, kwargs) in the order they are applied.
         """
-        category_dict_name_ind = dataset.categories().get(AnnotationType.label)._indices
-        category_dict_ind_name = {v: k for k, v in category_dict_name_ind.items()}
+        transforms = []
+        if self.splits:
+            transforms.append(('random_split', {'splits': self.splits}))
 
-        for item in dataset:
-            for annotation in item.annotations:
-                annotation.label = labels_id_mapping[category_dict_ind_name[annotation.label]]
-                
-        dataset.categories().get(AnnotationType.label)._indices = labels_id_mapping
+        if self.mapping:
+            # Example mapping: [('source_label', 'target_label')]
+            transforms.append((RemapLabelsTable, {'mapping': self.mapping}))
 
-        return dataset
+        if self.labels_id_mapping:
+            transforms.append((ReindexLabels, {'labels_id_mapping': self.labels_id_mapping}))
+
+        return transforms
 
     def _export_coco(self, dataset: Dataset, path: str) -> None:
         """
@@ -124,7 +346,58 @@ class CustomDataset:
         """
         exporter = dataset.env.exporters['coco']
         exporter._TASK_CONVERTER[CocoTask.instances] = PatchInstancesExporter
-        dataset.export(save_dir=path, format=exporter, save_media=True)
+        dataset.export(save_dir=path, format=exporter, save_media=False)
+        self._export_media(dataset, path)
+
+    def _export_media(self, dataset: Dataset, path: str, link: bool = None) -> None:
+        """
+        Save images of the dataset to '<path>/images/<subset>/<item_id><ext>'.
+
+        :param dataset: Datumaro dataset.
+        :param path: Path to save the dataset.
+        :param link: Whether to hard-link the images. Default: None, as set by link_media.
+        """
+        link = self.link_media if link is None else link
+        images = []
+        for subset_name, subset in dataset.subsets().items():
+            images_dir = os.path.join(path, 'images', subset_name)
+            for item in subset:
+                if isinstance(item.media, Image) and item.media.has_data:
+                    images.append((item.media, os.path.join(images_dir, _image_filename(item))))
+
+        # Linking and copying are syscall-bound, overlap them in threads
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            list(executor.map(lambda image: self._save_image(*image, link), images))
+
+    def _save_image(self, image: Image, image_path: str, link: bool) -> None:
+        """
+        Save an image by hard-linking or copying its source file.
+
+        :param image: Datumaro image.
+        :param image_path: Path to save the image.
+        :param link: Whether to try a hard link first, copying is the fallback.
+        """
+        os.makedirs(os.path.dirname(image_path), exist_ok=True)
+
+        source_path = getattr(image, 'path', None)
+        if not source_path or not os.path.isfile(source_path):
+            image.save(image_path)
+            return
+
+        if link:
+            try:
+                os.link(source_path, image_path)
+                return
+            except OSError:
+                # Different filesystems, no hard link support or the target exists: copy instead
+                pass
+
+        if os.path.splitext(image_path)[1] == image.ext:
+            # Image.save reads the whole file into memory, copyfile copies in the kernel
+            # where possible
+            shutil.copyfile(source_path, image_path)
+        else:
+            image.save(image_path)
 
     def _export_yolo(self, dataset: Dataset, path: str) -> None:
         """
@@ -144,7 +417,95 @@ class CustomDataset:
         )
 
         coco2yolo.convert()
-        os.system(f'rm -rf {path}/annotations')
+
+        # The intermediate COCO annotations are no longer needed, remove them without blocking
+        # the caller. The thread is not a daemon, so the interpreter still waits for the removal
+        # to finish on exit.
+        threading.Thread(
+            target=shutil.rmtree,
+            args=(os.path.join(path, 'annotations'),),
+            kwargs={'ignore_errors': True},
+        ).start()
+
+    @staticmethod
+    def _yolo_box(instance: list, width: int, height: int) -> list:
+        """
+        Convert an instance (group of annotations) into a YOLO box row.
+
+        Follows the COCO instances exporter: the box of a group is the max box of its boxes (or of
+        all its shapes), crowd instances and degenerate boxes are skipped. As in
+        _InstancesExporter.find_instance_parts, an instance is crowd only if its leader asks for
+        a mask and the group has polygons or masks to build it from.
+
+        :param instance: Annotations forming one instance.
+        :param width: Image width.
+        :param height: Image height.
+
+        :return: [class, x_center, y_center, width, height] normalized to image size, or None.
+        """
+        boxes = [a for a in instance if a.type == AnnotationType.bbox]
+        polygons = [a for a in instance if a.type in POLYGON_TYPES]
+        masks = [a for a in instance if a.type == AnnotationType.mask]
+        # Same order as the exporter, the leader is picked from it
+        leader = anno_tools.find_group_leader(boxes + polygons + masks)
+
+        use_masks = True is leader.attributes.get(
+            "is_crowd", find(masks, lambda x: x.label == leader.label) is not None
+        )
+        if use_masks and (polygons or masks):
+            return None
+
+        box = anno_tools.max_bbox(boxes or instance)
+        x, y, w, h = [round(float(n), COORDINATE_ROUNDING_DIGITS) for n in box]
+        if w <= 0 or h <= 0:
+            return None
+
+        return [
+            cast(leader.label, int, -1),
+            (x + w / 2) / width, (y + h / 2) / height, w / width, h / height,
+        ]
+
+    def _export_yolo_direct(self, dataset: Dataset, path: str) -> None:
+        """
+        Export dataset in YOLO detection format straight from the Datumaro items.
+
+        Produces the same layout as _export_yolo, but without writing and reading back COCO JSON.
+
+        :param dataset: Datumaro dataset.
+        :param path: Path to save the dataset.
+        """
+        labels_path = os.path.join(path, 'labels')
+        self._export_media(dataset, path)
+
+        for subset_name, subset in dataset.subsets().items():
+            labels_dir = os.path.join(labels_path, subset_name)
+            os.makedirs(labels_dir, exist_ok=True)
+
+            for item in subset:
+                instances = _InstancesExporter.find_instances(item.annotations)
+                if not instances:
+                    continue
+
+                if not item.media or not item.media.size:
+                    self.logger.warning(
+                        f'Item "{item.id}": annotations are skipped since no image size available'
+                    )
+                    continue
+
+                height, width = item.media.size
+                rows = [self._yolo_box(instance, width, height) for instance in instances]
+                rows = [row for row in rows if row]
+                if not rows:
+                    continue
+
+                label_path = os.path.join(labels_dir, f'{item.id}.txt')
+                os.makedirs(os.path.dirname(label_path), exist_ok=True)
+                with open(label_path, 'w', encoding='utf-8') as file:
+                    file.write(''.join(COCOConverter.format_yolo_line(row) for row in rows))
+
+        label_indices = dataset.categories().get(AnnotationType.label)._indices
+        label_map = {ind: name for name, ind in label_indices.items()}
+        COCOConverter(json_dir=None, save_dir=labels_path).generate_yolo_dataset_config(label_map)
 
     def export_dataset(self, save_path: str = None) -> None:
         """
@@ -152,20 +513,24 @@ class CustomDataset:
 
         :param save_path: Path to save the transformed dataset.
         """
-        if self.splits:
-            self.dataset = self.dataset.transform('random_split', splits=self.splits)
-        
-        if self.mapping:
-            self.dataset = self._mapping_labels(self.dataset, self.mapping)
+        transforms = self._get_transforms()
+        for transform, kwargs in transforms:
+            self.dataset = self.dataset.transform(transform, **kwargs)
+
+        if transforms:
+            # Apply the stacked transforms in a single pass, the exporters iterate the items
+            # more than once
+            self.dataset.init_cache()
 
-        if self.labels_id_mapping:
-            self.dataset = self._reindex_labels(self.dataset, self.labels_id_mapping)
-        
         if not save_path or save_path == self.datasets_path:
             save_path = f'{self.datasets_path}_{self.export_format}'
 
         if 'yolo' in self.export_format:
-            self._export_yolo(self.dataset, save_path)
+            # Segments need the polygon merging of COCOConverter, boxes are exported directly
+            if 'seg' in self.export_format:
+                self._export_yolo(self.dataset, save_path)
+            else:
+                self._export_yolo_direct(self.dataset, save_path)
         elif 'coco' in self.export_format:
             self._export_coco(self.dataset, save_path)
         else:
@@ -2,12 +2,21 @@
 Description: Convert COCO JSON to YOLO format with segmentation support.
 """
 import os
-import json
+import math
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
 import yaml
-from collections import defaultdict
+import orjson
 import numpy as np
 from tqdm import tqdm
 
+# Number of images sent to a worker process at once
+LABELS_CHUNK_SIZE = 64
+# Datasets with fewer annotated images are converted in the main process,
+# starting workers costs more
+LABELS_INLINE_LIMIT = 1024
+
 class COCOConverter:
     """
     Convert COCO to new format.
@@ -51,19 +60,23 @@ class COCOConverter:
 
         :return: A pair of indexes with the shortest distance.
         """
-        dis = ((arr1[:, None, :] - arr2[None, :, :]) ** 2).sum(-1)
+        # Squared distances per axis, accumulated in place without an (N, M, 2) temporary
+        dis = np.subtract.outer(arr1[:, 0], arr2[:, 0])
+        dis *= dis
+        dy = np.subtract.outer(arr1[:, 1], arr2[:, 1])
+        dy *= dy
+        dis += dy
         return np.unravel_index(np.argmin(dis, axis=None), dis.shape)
 
-    def _merge_multi_segment(self, segments: list) -> list:
+    def _merge_multi_segment(self, segments: list) -> np.ndarray:
         """
         Merge multiple segments into one.
 
         :param segments: The segments to merge.
 
-        :return: The merged segments.
+        :return: The merged segment as an array of points.
         """
-        s = []
-        segments = [np.array(i).reshape(-1, 2) for i in segments]
+        segments = [np.array(i, dtype=np.float64).reshape(-1, 2) for i in segments]
         idx_list = [[] for _ in range(len(segments))]
 
         for i in range(1, len(segments)):
@@ -71,76 +84,105 @@ class COCOConverter:
             idx_list[i - 1].append(idx[0])
             idx_list[i].append(idx[1])
 
-        for k in range(2):
-            if k == 0:
-                for i, idx in enumerate(idx_list):
-                    if len(idx) == 2 and idx[0] > idx[1]:
-                        idx = idx[::-1]
-                        segments[i] = segments[i][::-1, :]
-
-                    segments[i] = np.roll(segments[i], -idx[0], axis=0)
-                    segments[i] = np.concatenate([segments[i], segments[i][:1]])
-                    if i in [0, len(idx_list) - 1]:
-                        s.append(segments[i])
-                    else:
-                        idx = [0, idx[1] - idx[0]]
-                        s.append(segments[i][idx[0]:idx[1] + 1])
+        # Each segment is rolled to start at its first connection point and closed with that point,
+        # the pieces are taken from it by index straight into one preallocated output
+        last = len(idx_list) - 1
+        forward, backward = [], []
+        for i, idx in enumerate(idx_list):
+            segment = segments[i]
+            if len(idx) == 2 and idx[0] > idx[1]:
+                idx = idx[::-1]
+                segment = segment[::-1, :]
+
+            ring = np.arange(idx[0], idx[0] + len(segment) + 1)
+            if i in [0, last]:
+                forward.append((segment, ring))
             else:
-                for i in range(len(idx_list) - 1, -1, -1):
-                    if i not in [0, len(idx_list) - 1]:
-                        idx = idx_list[i]
-                        nidx = abs(idx[1] - idx[0])
-                        s.append(segments[i][nidx:])
+                nidx = idx[1] - idx[0]
+                forward.append((segment, ring[:nidx + 1]))
+                backward.append((segment, ring[nidx:]))
+
+        pieces = forward + backward[::-1]
+        s = np.empty((sum(len(ring) for _, ring in pieces), 2), dtype=np.float64)
+        cursor = 0
+        for segment, ring in pieces:
+            np.take(segment, ring, axis=0, out=s[cursor:cursor + len(ring)], mode='wrap')
+            cursor += len(ring)
         return s
 
-    def _bbox_process(self, bbox: list, img_dimensions: tuple) -> list:
+    def _segment_points(self, segmentation: list) -> np.ndarray:
+        """
+        Get the points of a single annotation segmentation, merging multiple polygons into one.
+
+        :param segmentation: The COCO segmentation polygons.
+
+        :return: The segment points as an (N, 2) array.
+        """
+        if len(segmentation) > 1:
+            return self._merge_multi_segment(segmentation)
+
+        segment = [j for i in segmentation for j in i]
+        return np.array(segment).reshape(-1, 2)
+
+    def _valid_boxes(self, anns: list, img_dimensions: tuple) -> tuple:
         """
-        Process a single annotation into a bbox format.
+        Convert the boxes of an image and drop crowd annotations and invalid boxes.
 
-        :param bbox: The bbox to process.
+        :param anns: The annotations of the image.
         :param img_dimensions: The dimensions of the image.
 
-        :return: The processed bbox.
+        :return: The kept annotations and their boxes in normalized center xywh format.
         """
         h, w = img_dimensions
-        box = np.array(bbox, dtype=np.float64)
-        box[:2] += box[2:] / 2
-        box[[0, 2]] /= w
-        box[[1, 3]] /= h
+        anns = [ann for ann in anns if not ann['iscrowd']]
+        if not anns:
+            return [], []
 
-        return box.tolist()
-    
-    def _process_annotation(self, ann: dict, img_dimensions: tuple) -> tuple:
+        # Convert all boxes of the image at once: xywh -> normalized center xywh
+        boxes = np.array([ann['bbox'] for ann in anns], dtype=np.float64).reshape(-1, 4)
+        boxes[:, :2] += boxes[:, 2:] / 2
+        boxes *= np.array([1.0 / w, 1.0 / h, 1.0 / w, 1.0 / h])
+        valid = (boxes[:, 2] > 0) & (boxes[:, 3] > 0)  # Skip invalid boxes
+
+        return [ann for ann, keep in zip(anns, valid.tolist()) if keep], boxes[valid].tolist()
+
+    def _process_boxes(self, anns: list, img_dimensions: tuple) -> list:
         """
-        Process a single annotation into a bbox or segment format.
+        Process the annotations of an image into bbox rows.
 
-        :param ann: The annotation to process.
+        :param anns: The annotations of the image.
         :param img_dimensions: The dimensions of the image.
 
-        :return: The processed bbox or segment.
+        :return: The processed bboxes.
         """
-        h, w = img_dimensions
-        if ann['iscrowd']:
-            return None, None
-        
-        box = self._bbox_process(ann['bbox'], img_dimensions)
-        if box[2] <= 0 or box[3] <= 0:  # Skip invalid boxes
-            return None, None
-
-        cls = ann['category_id'] - 1
-        box = [cls] + box
-
-        segment = None
-        if self.use_segments and 'segmentation' in ann:
-            if len(ann['segmentation']) > 1:
-                merged_segment = self._merge_multi_segment(ann['segmentation'])
-                segment = (np.concatenate(merged_segment, axis=0) / np.array([w, h])).reshape(-1).tolist()
-            else:
-                segment = [j for i in ann['segmentation'] for j in i]
-                segment = (np.array(segment).reshape(-1, 2) / np.array([w, h])).reshape(-1).tolist()
-            segment = [cls] + segment
+        anns, boxes = self._valid_boxes(anns, img_dimensions)
+        return [[ann['category_id'] - 1] + box for ann, box in zip(anns, boxes)]
+
+    def _process_segments(self, anns: list, img_dimensions: tuple) -> list:
+        """
+        Process the annotations of an image with valid boxes into segment rows.
 
-        return box, segment
+        :param anns: The annotations of the image.
+        :param img_dimensions: The dimensions of the image.
+
+        :return: The processed segments.
+        """
+        h, w = img_dimensions
+        anns, _ = self._valid_boxes(anns, img_dimensions)
+        anns = [ann for ann in anns if 'segmentation' in ann]
+        if not anns:
+            return []
+
+        # Normalize the points of all segments of the image at once, then cut them back per segment
+        points = [self._segment_points(ann['segmentation']) for ann in anns]
+        coords = np.concatenate(points, axis=0) * np.array([1.0 / w, 1.0 / h])
+        coords = coords.reshape(-1).tolist()
+        ends = np.cumsum([2 * len(segment) for segment in points]).tolist()
+
+        return [
+            [ann['category_id'] - 1] + coords[start:end]
+            for ann, start, end in zip(anns, [0] + ends[:-1], ends)
+        ]
     
     def _get_label_map(self, categories: list) -> dict:
         """
@@ -154,38 +196,92 @@ class COCOConverter:
         #     return {int(v): k for k, v in self.labels_id_mapping.items()}
         return {int(cat['id']) - 1: cat['name'] for cat in categories}
     
-    def _make_yolo_annotation(self, sub_dataset_path: str, data: dict):
+    def _group_annotations(self, data: dict) -> tuple:
         """
-        Make YOLO annotation file.
+        Group COCO annotations by image.
 
-        :param sub_dataset_path: The path to the sub dataset.
         :param data: The COCO JSON data.
+
+        :return: The annotated images and the list of annotations of each of them.
         """
         images = {img["id"]: img for img in data['images']}
-        img_to_anns = defaultdict(list)
-        for ann in data['annotations']:
-            img_to_anns[ann['image_id']].append(ann)
-
-        for img_id, anns in tqdm(img_to_anns.items(), desc=f'Annotations {sub_dataset_path}'):
-            img = images[img_id]
-            h, w, file_name = img['height'], img['width'], img['file_name']
-            img_dimensions = (h, w)
-
-            bboxes, segments = [], []
-            for ann in anns:
-                box, segment = self._process_annotation(ann, img_dimensions)
-                if box:
-                    bboxes.append(box)
-                if segment:
-                    segments.append(segment)
-
-            img_name = file_name.split('.')[0]
-            with open(os.path.join(sub_dataset_path, f'{img_name}.txt'), 'w') as file:
-                for box_or_seg in (segments if self.use_segments else bboxes):
-                    line = ' '.join(map(str, box_or_seg))
-                    file.write(line + '\n')
-
-    def _generate_yolo_dataset_config(self, label_map: dict):
+        annotations = data['annotations']
+
+        # Group annotations by image with one stable sort instead of growing a list per image
+        image_ids = np.fromiter(
+            (ann['image_id'] for ann in annotations), dtype=np.int64, count=len(annotations)
+        )
+        order = np.argsort(image_ids, kind='stable')
+        unique_ids, starts = np.unique(image_ids[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        order = order.tolist()
+
+        imgs = [images[img_id] for img_id in unique_ids.tolist()]
+        img_anns = [
+            [annotations[i] for i in order[start:end]]
+            for start, end in zip(starts.tolist(), ends.tolist())
+        ]
+        return imgs, img_anns
+
+    def _make_yolo_annotation(
+        self, sub_dataset_path: str, imgs: list, img_anns: list, executor=None
+    ):
+        """
+        Make YOLO annotation file.
+
+        :param sub_dataset_path: The path to the sub dataset.
+        :param imgs: The annotated COCO images.
+        :param img_anns: The annotations of each image.
+        :param executor: Process pool to convert the images in, None to convert them
+            in this process.
+        """
+        write_labels = partial(self._write_labels, sub_dataset_path)
+        if executor is None:
+            results = map(write_labels, imgs, img_anns)
+        else:
+            results = executor.map(write_labels, imgs, img_anns, chunksize=LABELS_CHUNK_SIZE)
+
+        for _ in tqdm(results, total=len(imgs), desc=f'Annotations {sub_dataset_path}'):
+            pass
+
+    def _write_labels(self, sub_dataset_path: str, img: dict, anns: list):
+        """
+        Write the YOLO label file of a single image.
+
+        :param sub_dataset_path: The path to the sub dataset.
+        :param img: The COCO image.
+        :param anns: The annotations of the image.
+        """
+        h, w, file_name = img['height'], img['width'], img['file_name']
+        img_dimensions = (h, w)
+
+        if self.use_segments:
+            rows = self._process_segments(anns, img_dimensions)
+        else:
+            rows = self._process_boxes(anns, img_dimensions)
+
+        # Only crowd or invalid annotations: no label file, YOLO treats a missing one as background
+        if not rows:
+            return
+
+        img_name = file_name.split('.')[0]
+        # Build the whole file first and write it at once
+        lines = ''.join(self.format_yolo_line(row) for row in rows)
+        with open(os.path.join(sub_dataset_path, f'{img_name}.txt'), 'w', encoding='utf-8') as file:
+            file.write(lines)
+
+    @staticmethod
+    def format_yolo_line(row: list) -> str:
+        """
+        Format a YOLO label row: the class as an integer, the coordinates with 6 decimals.
+
+        :param row: The row in the format: [class, x1, y1, ...].
+
+        :return: The formatted line ending with a newline.
+        """
+        return ('%d' + ' %.6f' * (len(row) - 1) + '\n') % tuple(row)
+
+    def generate_yolo_dataset_config(self, label_map: dict):
         """
         Generate the dataset config in ultralitycs format for yolov8
 
@@ -222,7 +318,13 @@ class COCOConverter:
         os.makedirs(self.save_dir, exist_ok=True)
 
         # Get only instance segmentation COCO JSONs and sort them
-        sub_dataset_json_paths = [os.path.join(self.json_dir, json_file) for json_file in os.listdir(self.json_dir) if "instances_" in json_file and json_file.endswith('.json')]
+        with os.scandir(self.json_dir) as entries:
+            sub_dataset_json_paths = [
+                entry.path for entry in entries
+                if "instances_" in entry.name and entry.name.endswith('.json') and entry.is_file()
+            ]
+
+        subsets = []
         for json_file in sub_dataset_json_paths:
 
             # Create a sub dataset directory to save the converted labels(ususally the same as the json file name: train, val, test)
@@ -231,14 +333,30 @@ class COCOConverter:
             os.makedirs(sub_dataset_path, exist_ok=True)
 
             # Load COCO JSON
-            with open(json_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            with open(json_file, 'rb') as f:
+                data = orjson.loads(f.read())
+
+            subsets.append((sub_dataset_path, *self._group_annotations(data)))
+
+        # One process pool for all subsets, with no more workers than chunks of the largest one;
+        # small datasets and a single worker gain nothing from it
+        images_num = sum(len(imgs) for _, imgs, _ in subsets)
+        max_chunks = max(
+            (math.ceil(len(imgs) / LABELS_CHUNK_SIZE) for _, imgs, _ in subsets), default=1
+        )
+        workers = min(os.cpu_count() or 1, max_chunks)
+        if images_num < LABELS_INLINE_LIMIT or workers < 2:
+            pool = nullcontext()
+        else:
+            pool = ProcessPoolExecutor(max_workers=workers)
 
-            # Make YOLO annotation file
-            self._make_yolo_annotation(sub_dataset_path, data)
+        with pool as executor:
+            for sub_dataset_path, imgs, img_anns in subsets:
+                # Make YOLO annotation file
+                self._make_yolo_annotation(sub_dataset_path, imgs, img_anns, executor)
 
         label_map = self._get_label_map(data['categories'])
-        self._generate_yolo_dataset_config(label_map)
+        self.generate_yolo_dataset_config(label_map)
         
 
     def convert(self):
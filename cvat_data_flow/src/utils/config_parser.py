@@ -1,57 +1,240 @@
 import ast
 import configparser
+import json
+import os
+import re
+
+# Parsed config files by absolute path with the (mtime, size) they were parsed at,
+# unchanged files are not read again
+_PARSE_CACHE = {}
+
+# Items of a list option: runs of anything but whitespace, commas and brackets
+_LIST_ITEM_RE = re.compile(r'[^\s,\[\]]+')
+# Bare words json accepts but ast.literal_eval does not, dicts containing them go to ast
+_JSON_ONLY_LITERAL_RE = re.compile(r'\b(?:null|true|false|NaN|Infinity)\b')
+_BOOLEAN_STATES = {
+    '1': True, 'yes': True, 'true': True, 'on': True,
+    '0': False, 'no': False, 'false': False, 'off': False,
+}
+
+
+def _parse_bool(value):
+    state = _BOOLEAN_STATES.get(value.lower())
+    if state is None:
+        raise ValueError(f'Not a boolean: {value}')
+    return state
+
+
+def _parse_dict(value):
+    # Plain {'key': value} dicts are valid JSON once quoted, the json scanner is much faster
+    # than ast; values with double quotes or escapes could change meaning, they go to ast
+    if '"' not in value and '\\' not in value and not _JSON_ONLY_LITERAL_RE.search(value):
+        try:
+            return json.loads(value.replace("'", '"'))
+        except ValueError:
+            pass
+    return ast.literal_eval(value)
+
+
+def _parse_list(value):
+    return _LIST_ITEM_RE.findall(value)
 
 
 class Config:
+    # Same header syntax as configparser
+    _SECTION_RE = re.compile(r'\[(?P<header>.+)\]')
+    # Converters by expected type, other types get the raw string
+    _PARSERS = {int: int, float: float, bool: _parse_bool, dict: _parse_dict, list: _parse_list}
+
     def __init__(self, config_file):
-        self.config = configparser.ConfigParser()
-        self.config.read(config_file)
+        # {section: {option: raw value}}, options are lowercased as configparser does
+        self._data = self._load(config_file)
+        # Parsed values by (section, option, type), options are converted only once
+        self._cache = {}
+
+    @classmethod
+    def clear_cache(cls):
+        _PARSE_CACHE.clear()
+
+    @classmethod
+    def _load(cls, config_file):
+        try:
+            stat = os.stat(config_file)
+        except OSError:
+            return cls._read(config_file)
+
+        path = os.path.abspath(config_file)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = _PARSE_CACHE.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        data = cls._read(config_file)
+        _PARSE_CACHE[path] = (signature, data)
+        return data
+
+    @classmethod
+    def _read(cls, config_file):
+        # A missing file gives an empty config, like ConfigParser.read
+        try:
+            with open(config_file, 'r', encoding='utf-8') as file:
+                lines = file.read().splitlines()
+        except OSError:
+            return {}
+
+        data = {}
+        section_name = None
+        option = None
+        option_indent = 0
+        blank_lines = 0
+        for lineno, line in enumerate(lines, start=1):
+            value = line.strip()
+            if not value or value[0] in '#;':
+                # Neither ends a multiline value, blank lines are kept only if the value
+                # continues after them
+                if not value:
+                    blank_lines += 1
+                continue
+
+            indent = len(line) - len(line.lstrip())
+            if option is not None and indent > option_indent:
+                # Continuation of a multiline value, an option is only set inside a section
+                data[section_name][option] += '\n' * (blank_lines + 1) + value
+                blank_lines = 0
+                continue
+
+            blank_lines = 0
+
+            header = cls._SECTION_RE.match(value)
+            if header:
+                section_name = header.group('header')
+                data.setdefault(section_name, {})
+                option = None
+                continue
+
+            if section_name is None:
+                raise configparser.MissingSectionHeaderError(config_file, lineno, line)
+
+            # The first of '=' and ':' separates the option from its value
+            option, delimiter, option_value = value.partition('=')
+            if not delimiter or ':' in option:
+                option, delimiter, option_value = value.partition(':')
+
+            option = option.rstrip()
+            if not delimiter or not option:
+                error = configparser.ParsingError(config_file)
+                error.append(lineno, repr(line))
+                raise error
+
+            option = option.lower()
+            option_indent = indent
+            data[section_name][option] = option_value.lstrip()
+
+        # Options of the DEFAULT section are visible in every other section
+        defaults = data.pop(configparser.DEFAULTSECT, {})
+        return {name: {**defaults, **options} for name, options in data.items()}
 
     def get(self, section, option, type):
-        if type == int:
-            return self.config.getint(section, option)
-        elif type == float:
-            return self.config.getfloat(section, option)
-        elif type == bool:
-            return self.config.getboolean(section, option)
-        elif type == dict:
-            # If the expected type is a dictionary, use ast.literal_eval
-            return ast.literal_eval(self.config.get(section, option))
-        elif type == list:
-            # Strip the [] characters and split on commas
-            return [item.strip() for item in self.config.get(section, option).strip('[]').split(',') if item.strip()]
-        else:
-            return self.config.get(section, option)
+        key = (section, option, type)
+        if key in self._cache:
+            return self._cache[key]
 
+        value = self._parse(self._get_raw(section, option), type)
+        self._cache[key] = value
+        return value
 
-class Options:
-    def __init__(self, config_file = 'config.ini'):
-        config = Config(config_file)
+    def _get_raw(self, section, option):
+        try:
+            return self._data[section][option.lower()]
+        except KeyError:
+            if section not in self._data:
+                raise configparser.NoSectionError(section) from None
+            raise configparser.NoOptionError(option, section) from None
 
-        # cvat
-        self.url = config.get('CVAT', 'URL', str)
-        self.login = config.get('CVAT', 'LOGIN', str)
-        self.password = config.get('CVAT', 'PASS', str)
+    def _parse(self, value, type):
+        parser = self._PARSERS.get(type)
+        return value if parser is None else parser(value)
 
-        # download
-        self.tasks_ids = config.get('DOWNLOAD', 'TASKS_IDS', list)
-        self.projects_ids = config.get('DOWNLOAD', 'PROJECTS_IDS', list)
 
+class Options:
+    # attribute: (section, option, type)
+    _FIELDS = {
+        # cvat
+        'url': ('CVAT', 'URL', str),
+        'login': ('CVAT', 'LOGIN', str),
+        'password': ('CVAT', 'PASS', str),
+        # download
+        'tasks_ids': ('DOWNLOAD', 'TASKS_IDS', list),
+        'projects_ids': ('DOWNLOAD', 'PROJECTS_IDS', list),
         # dataset
-        self.format = config.get('DATASET', 'FORMAT', str)
-        self.save_path = config.get('DATASET', 'SAVE_PATH', str)
-        self.raw_data_path = config.get('DATASET', 'RAW_DATA_PATH', str)
-        self.split = [
-            (str(key), float(value)) for key, value in config.get('DATASET', 'SPLIT', dict).items()
-        ]
-
+        'format': ('DATASET', 'FORMAT', str),
+        'save_path': ('DATASET', 'SAVE_PATH', str),
+        'raw_data_path': ('DATASET', 'RAW_DATA_PATH', str),
+        'split': ('DATASET', 'SPLIT', dict),
         # options
-        self.only_build_dataset = config.get('OPTIONS', 'ONLY_BUILD_DATASET', bool)
-        self.labels_mapping = [
-            (str(key), str(value)) for key, value in config.get('OPTIONS', 'LABELS_MAPPING', dict).items()
-        ]
-        if len(self.labels_mapping) == 0:
-            self.labels_mapping = None
-
-        self.labels_id_mapping = config.get('OPTIONS', 'LABELS_ID_MAPPING', dict)
-        self.debug = config.get('OPTIONS', 'DEBUG', bool)
\ No newline at end of file
+        'only_build_dataset': ('OPTIONS', 'ONLY_BUILD_DATASET', bool),
+        'labels_mapping': ('OPTIONS', 'LABELS_MAPPING', dict),
+        'labels_id_mapping': ('OPTIONS', 'LABELS_ID_MAPPING', dict),
+        'debug': ('OPTIONS', 'DEBUG', bool),
+    }
+
+    # Converted options are stored in slots, __getattr__ fills them on first access
+    __slots__ = ('_config', *_FIELDS)
+
+    # Instances by absolute config path with the (mtime, size) of the file they were created from
+    _INSTANCES = {}
+
+    def __new__(cls, config_file = 'config.ini'):
+        # The same unchanged file gives the same instance, with the options it already converted
+        try:
+            stat = os.stat(config_file)
+        except OSError:
+            signature = None
+        else:
+            signature = (stat.st_mtime_ns, stat.st_size)
+
+        path = os.path.abspath(config_file)
+        cached = cls._INSTANCES.get(path)
+        if signature is not None and cached is not None and cached[0] == signature:
+            return cached[1]
+
+        instance = super().__new__(cls)
+        instance._config = Config(config_file)
+        if signature is not None:
+            cls._INSTANCES[path] = (signature, instance)
+        return instance
+
+    def __getattr__(self, name):
+        # Only called for attributes not set yet: options are converted on first access
+        # and then stored
+        try:
+            section, option, type = self._FIELDS[name]
+        except KeyError:
+            raise AttributeError(
+                f"'{self.__class__.__name__}' object has no attribute '{name}'"
+            ) from None
+
+        value = self._convert(name, self._config.get(section, option, type))
+        setattr(self, name, value)
+        return value
+
+    @staticmethod
+    def _convert(name, value):
+        if name == 'split':
+            # {subset name: ratio}, bools are ints in Python but not valid ratios
+            if not isinstance(value, dict) or not all(
+                isinstance(key, str)
+                and isinstance(ratio, (int, float))
+                and not isinstance(ratio, bool)
+                for key, ratio in value.items()
+            ):
+                raise ValueError(f'SPLIT must map subset names to numbers: {value}')
+            return [(key, float(ratio)) for key, ratio in value.items()]
+        if name == 'labels_mapping':
+            # {source label: target label}
+            if not isinstance(value, dict) or not all(
+                isinstance(key, str) and isinstance(label, str) for key, label in value.items()
+            ):
+                raise ValueError(f'LABELS_MAPPING must map label names to label names: {value}')
+            return list(value.items()) or None
+        return value